@@ -1,14 +1,26 @@
 import os
-import json
+import orjson
 import asyncio
 import boto3
 import time
-from typing import List, Dict, Optional
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, UploadFile, File, HTTPException, Form
-from fastapi.responses import HTMLResponse
-from pydantic import BaseModel
+import hmac
+import hashlib
+import secrets
+import zlib
+import gzip
+import itertools
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from urllib.parse import quote
+from typing import Dict, Optional, Set, Tuple
+from fastapi import FastAPI, Request, Header, WebSocket, WebSocketDisconnect, UploadFile, File, HTTPException, Form
+from fastapi.responses import HTMLResponse, Response
+import msgspec
 from redis import asyncio as aioredis
 from botocore.config import Config
+from boto3.s3.transfer import TransferConfig
 
 # ==========================================
 # KUSTIFY HYPER-X | V9.4 (VC FIX + METADATA SYNC)
@@ -32,218 +44,758 @@ AWS_SECRET_KEY = os.getenv("BUCKETEER_AWS_SECRET_ACCESS_KEY")
 AWS_REGION = os.getenv("BUCKETEER_AWS_REGION")
 BUCKET_NAME = os.getenv("BUCKETEER_BUCKET_NAME")
 
+# 3. Scale-out: only multi-process deployments need group traffic relayed through Redis pub/sub.
+# On by default when uvicorn runs several workers (WEB_CONCURRENCY), or force with SCALE_OUT=1/0.
+SCALE_OUT = os.getenv("SCALE_OUT", "1" if int(os.getenv("WEB_CONCURRENCY", "1")) > 1 else "0") == "1"
+NODE_ID = os.urandom(4).hex().encode() # Tags this process's publishes so redis_listener can skip its own echoes
+logger = logging.getLogger("kustify")
+_MSG_SEQ = itertools.count() # Per-process message counter; with NODE_ID it makes ids unique across workers and restarts
+_MSG_ID_PREFIX = f"msg_{NODE_ID.decode()}_"
+
+# 4. Only trust X-Forwarded-For behind a router that appends the real peer (Heroku sets DYNO); force with TRUST_PROXY=1/0
+TRUST_PROXY = os.getenv("TRUST_PROXY", "1" if os.getenv("DYNO") else "0") == "1"
+
 # Initialize Redis & S3
-redis = aioredis.from_url(REDIS_URL, decode_responses=True)
+# Blocking pool: under load callers wait for a free connection instead of erroring out.
+# Health checks catch connections a managed Redis dropped while idle; hiredis (if installed) parses replies.
+redis_pool = aioredis.BlockingConnectionPool.from_url(REDIS_URL, decode_responses=True, max_connections=100, socket_keepalive=True, health_check_interval=30)
+redis = aioredis.Redis(connection_pool=redis_pool)
+# Raw-bytes client for the message hot path (history, pub/sub): payloads are orjson bytes end to end
+redis_bin = aioredis.Redis(connection_pool=aioredis.BlockingConnectionPool.from_url(REDIS_URL, max_connections=32, socket_keepalive=True, health_check_interval=30))
+pubsub = redis_bin.pubsub()
 s3_client = boto3.client(
     's3',
     aws_access_key_id=AWS_ACCESS_KEY,
     aws_secret_access_key=AWS_SECRET_KEY,
     region_name=AWS_REGION,
-    config=Config(signature_version='s3v4')
+    config=Config(
+        signature_version='s3v4',
+        max_pool_connections=50, # Room for 4-part concurrent uploads across parallel requests
+        tcp_keepalive=True,
+        retries={'max_attempts': 3, 'mode': 'adaptive'}
+    )
 )
-
-GLOBAL_CHANNEL = "kustify:global:v9"
-GROUPS_KEY = "kustify:groups:v9" # Set of public group names
+# Attachments over 8MB go up as 20MB multipart parts, 4 in flight, instead of one buffered PUT
+UPLOAD_TRANSFER_CONFIG = TransferConfig(multipart_threshold=8*1024*1024, multipart_chunksize=20*1024*1024, max_concurrency=4, use_threads=True)
+S3_HOST = f"{BUCKET_NAME}.s3.{AWS_REGION or 'us-east-1'}.amazonaws.com"
+
+@lru_cache(maxsize=2)
+def _sigv4_signing_key(datestamp: str) -> bytes:
+    # The derived key only depends on the UTC date, so it is computed once per day
+    key = f"AWS4{AWS_SECRET_KEY}".encode()
+    for part in (datestamp, AWS_REGION or "us-east-1", "s3", "aws4_request"):
+        key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+    return key
+
+def _sign_get_url(file_key: str, expires: int) -> str:
+    """Presigned GET URL signed locally with SigV4 query auth, skipping botocore's endpoint resolution."""
+    amz_date = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+    scope = f"{amz_date[:8]}/{AWS_REGION or 'us-east-1'}/s3/aws4_request"
+    path = quote(f"/{file_key}", safe="/-_.~")
+    query = (
+        "X-Amz-Algorithm=AWS4-HMAC-SHA256"
+        f"&X-Amz-Credential={quote(f'{AWS_ACCESS_KEY}/{scope}', safe='-_.~')}"
+        f"&X-Amz-Date={amz_date}&X-Amz-Expires={expires}&X-Amz-SignedHeaders=host"
+    )
+    canonical = f"GET\n{path}\n{query}\nhost:{S3_HOST}\n\nhost\nUNSIGNED-PAYLOAD"
+    to_sign = f"AWS4-HMAC-SHA256\n{amz_date}\n{scope}\n{hashlib.sha256(canonical.encode()).hexdigest()}"
+    signature = hmac.new(_sigv4_signing_key(amz_date[:8]), to_sign.encode(), hashlib.sha256).hexdigest()
+    return f"https://{S3_HOST}{path}?{query}&X-Amz-Signature={signature}"
+
+GLOBAL_CHANNEL = "kustify:global:v9" # Node-wide traffic: DMs, framed "<target user id>\x1f<json>"
+GROUP_CHANNEL = "kustify:ch:v9:" # Per-group pub/sub channel, subscribed only while a local socket is in the group
+VC_CHANNEL = "kustify:vc:v9:" # Per-group voice signaling, delivered only to sockets that joined VC
+GROUPS_CHANGED_CHANNEL = "kustify:groups_changed:v9" # Tells other processes to drop their public group list cache
+GROUPS_KEY = "kustify:groups:v9" # Sorted set of public group names, all score 0 so they read back in name order
 PVT_GROUPS_KEY = "kustify:pvt_groups:v9" # Set of private group names
 GROUP_META_KEY = "kustify:group_meta:v9:" # Hash for group details (password, owner)
+UPLOAD_SLOTS_KEY = "kustify:uploads:v9:" # Sorted set per client IP of in-flight proxied uploads, scored by start time
+PASSWORD_ATTEMPTS_KEY = "kustify:pw_attempts:v9:" # Sorted set per client IP of recent password hash/check requests
 HISTORY_KEY = "kustify:history:v9:"
-
-class GroupCreateRequest(BaseModel):
+MSG_INDEX_KEY = "kustify:msgindex:v9:" # Hash per group: message id -> stored JSON, for O(1) edit/delete lookups
+HISTORY_MIGRATION_KEY = "kustify:history_migrated:v9" # Version of the one-off history migration already applied
+HISTORY_MIGRATION = 1 # Bump when _migrate_history gains a step existing deployments still need
+MAX_HISTORY = int(os.getenv("MAX_HISTORY", "1000")) # History lists are trimmed to the newest N messages
+COMPRESS_MIN = 512 # Group frames at least this large are zlib-compressed once for all recipients
+MAX_FRAME = 32_768 # Largest inbound websocket frame (chars) before the socket is closed with 1009
+MAX_TEXT = 8192 # Longest chat message text accepted
+HISTORY_LIMIT_MAX = 500 # Most messages /api/history returns per request
+HISTORY_REPLAY = 100 # Newest messages sent to a socket right after it connects
+INGRESS_QUEUE_SIZE = 10000 # Chat messages awaiting their history write/publish before senders wait inline
+INGRESS_BATCH = 64 # Most messages written per ingress pipeline, so one burst can't build a huge request
+INGRESS_RETRIES = 3 # Attempts per ingress batch before its messages are dropped from history
+INGRESS_DRAIN_TIMEOUT = 10.0 # Seconds shutdown waits for queued messages to be written
+SEND_QUEUE_SIZE = 64 # Frames buffered per socket before a non-reading client is disconnected
+GROUP_NAME_MAX = 64 # Longest sanitized group name kept
+_UNSAFE_NAME_RE = re.compile(r"[^\w-]+") # Anything but letters, digits, '_' and '-' (unicode-aware, like str.isalnum)
+UPLOAD_CONCURRENCY = 3 # Proxied uploads one client IP may have in flight
+UPLOAD_SLOT_TTL = 300 # Seconds before a slot left by a crashed request stops counting
+PASSWORD_ITERATIONS = 600_000 # PBKDF2-SHA256 rounds for private group passwords; weaker stored hashes are upgraded on join
+PASSWORD_ATTEMPTS = 10 # Password joins/creates one client IP may make per PASSWORD_ATTEMPT_WINDOW, so PBKDF2 can't be farmed
+PASSWORD_ATTEMPT_WINDOW = 60 # Seconds
+PASSWORD_WORKERS = 2 # Threads for PBKDF2, kept apart from the default pool the S3 uploads run on
+GROUPS_PAGE = 500 # Names fetched per ZRANGEBYLEX when refreshing the public group list
+GROUPS_CACHE_TTL = 5.0 # Seconds the public group list and private group lookups are served from memory
+LEAVE_GRACE = 2.0 # Seconds a disconnected user has to reconnect before presence is re-broadcast
+PRESENCE_DEBOUNCE = 0.1 # Seconds presence changes are coalesced before one update per group goes out
+LISTENER_BACKOFF_MAX = 30.0 # Longest wait between redis_listener reconnect attempts
+UPLOAD_KEY_PREFIX = "kustify_v9/" # S3 key prefix for uploaded files
+UPLOAD_MAX_BYTES = 50_000_000 # Size cap enforced by S3 on direct (presigned POST) uploads
+HEARTBEAT_ACK = orjson.dumps({"type": "heartbeat_ack"}) # Constant reply, serialized once
+
+# Check-and-insert for a new group in one atomic round trip; returns 0 if the name is taken.
+# KEYS: public set, private set, meta hash. ARGV: name, type, password, publish-change flag
+CREATE_GROUP_LUA = redis.register_script("""
+if redis.call('ZSCORE', KEYS[1], ARGV[1]) or redis.call('SISMEMBER', KEYS[2], ARGV[1]) == 1 then return 0 end
+if ARGV[2] == 'private' then
+    redis.call('SADD', KEYS[2], ARGV[1])
+    if ARGV[3] ~= '' then redis.call('HSET', KEYS[3], 'password', ARGV[3], 'type', 'private') end
+else
+    redis.call('ZADD', KEYS[1], 0, ARGV[1])
+end
+if ARGV[4] == '1' then redis.call('PUBLISH', KEYS[4], ARGV[1]) end
+return 1
+""")
+
+# Chat message ingress: append to history and the id index, trim both, and relay to other nodes in one script call.
+# KEYS: history list, group channel, message index. ARGV: payload, MAX_HISTORY, relay prefix ('' = no relay), message id
+INGRESS_LUA = redis_bin.register_script("""
+if redis.call('HEXISTS', KEYS[3], ARGV[4]) == 1 then return end -- Already written by an attempt whose reply was lost
+redis.call('RPUSH', KEYS[1], ARGV[1])
+redis.call('HSET', KEYS[3], ARGV[4], ARGV[1])
+local over = redis.call('LLEN', KEYS[1]) - tonumber(ARGV[2])
+-- Normally one entry falls off. A bigger overflow (MAX_HISTORY lowered) is trimmed without decoding it;
+-- the index entries it leaves behind are dropped by edit/delete when they miss the list
+if over > 0 and over <= 32 then
+    for _, raw in ipairs(redis.call('LRANGE', KEYS[1], 0, over - 1)) do
+        local ok, m = pcall(cjson.decode, raw)
+        if ok and type(m) == 'table' and m.id then redis.call('HDEL', KEYS[3], m.id) end
+    end
+end
+if over > 0 then redis.call('LTRIM', KEYS[1], over, -1) end
+if ARGV[3] ~= '' then redis.call('PUBLISH', KEYS[2], ARGV[3] .. ARGV[1]) end
+""")
+INGRESS_RELAY_PREFIX = NODE_ID + b"\x1f" if SCALE_OUT else b"" # Same framing as relay_frame()
+
+# Shared prologue for edit/delete: finds message ARGV[1] owned by user ARGV[2] and leaves it in `raw`/`msg`.
+# KEYS: history list, message index. Older messages were indexed by _migrate_history, so a miss means no such message.
+_FIND_OWN_MESSAGE_LUA = """
+local raw = redis.call('HGET', KEYS[2], ARGV[1])
+if not raw then return 0 end
+local msg = cjson.decode(raw)
+if msg.user_id ~= ARGV[2] then return 0 end
+"""
+# ARGV[3]: new text. Returns 1 if the message was edited
+EDIT_LUA = redis_bin.register_script(_FIND_OWN_MESSAGE_LUA + """
+local pos = redis.call('LPOS', KEYS[1], raw)
+if not pos then redis.call('HDEL', KEYS[2], ARGV[1]); return 0 end -- Stale index entry, already trimmed
+msg.text = ARGV[3]
+msg.edited = true
+local updated = cjson.encode(msg)
+redis.call('LSET', KEYS[1], pos, updated)
+redis.call('HSET', KEYS[2], ARGV[1], updated)
+return 1
+""")
+# Returns 1 if the message was deleted
+DELETE_LUA = redis_bin.register_script(_FIND_OWN_MESSAGE_LUA + """
+redis.call('HDEL', KEYS[2], ARGV[1])
+return redis.call('LREM', KEYS[1], 1, raw) -- 0 if the index entry was stale
+""")
+
+# One-off per history list: trim to the newest ARGV[1] messages and index their ids. KEYS: history list, message index
+MIGRATE_HISTORY_LUA = redis_bin.register_script("""
+redis.call('LTRIM', KEYS[1], -tonumber(ARGV[1]), -1)
+for _, raw in ipairs(redis.call('LRANGE', KEYS[1], 0, -1)) do
+    local ok, m = pcall(cjson.decode, raw)
+    if ok and type(m) == 'table' and type(m.id) == 'string' then redis.call('HSET', KEYS[2], m.id, raw) end
+end
+""")
+
+# One-off conversion of the public group list from a plain set (older deployments) to the sorted set. KEYS: group list
+MIGRATE_GROUPS_LUA = redis.register_script("""
+if redis.call('TYPE', KEYS[1]).ok ~= 'set' then return 0 end
+local names = redis.call('SMEMBERS', KEYS[1])
+redis.call('DEL', KEYS[1])
+for _, name in ipairs(names) do redis.call('ZADD', KEYS[1], 0, name) end
+return #names
+""")
+
+# Concurrent-request limiter: drop expired slots, then take one if under the cap. Returns 1 if acquired.
+# Slots that are never released make it a sliding-window rate limit (password attempts).
+# KEYS: client's slot set. ARGV: now, slot TTL, cap, request id
+ACQUIRE_UPLOAD_SLOT_LUA = redis.register_script("""
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', tonumber(ARGV[1]) - tonumber(ARGV[2]))
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[3]) then return 0 end
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[4])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+""")
+
+# Membership check and password fetch for a private group in one atomic call.
+# KEYS: private set, meta hash. ARGV: name. Returns nil if no such group, '' if it has no password
+PRIVATE_GROUP_PASSWORD_LUA = redis.register_script("""
+if redis.call('SISMEMBER', KEYS[1], ARGV[1]) == 0 then return false end
+return redis.call('HGET', KEYS[2], 'password') or ''
+""")
+
+@lru_cache(maxsize=4096)
+def history_key_for(group_id: str) -> str: return f"{HISTORY_KEY}{group_id}"
+
+@lru_cache(maxsize=4096)
+def msg_index_key_for(group_id: str) -> str: return f"{MSG_INDEX_KEY}{group_id}"
+
+@lru_cache(maxsize=4096)
+def group_channel_for(group_id: str) -> str: return f"{GROUP_CHANNEL}{group_id}"
+
+@lru_cache(maxsize=4096)
+def vc_channel_for(group_id: str) -> str: return f"{VC_CHANNEL}{group_id}"
+
+_groups_cache = {"ts": 0.0, "groups": []} # Sorted public group names, refreshed after GROUPS_CACHE_TTL
+_private_cache: Dict[str, Tuple[float, Optional[str]]] = {} # name -> (fetched at, password ('' = open) or None if no such group)
+
+def _invalidate_group(name: str):
+    _groups_cache["ts"] = 0.0
+    _private_cache.pop(name, None)
+
+class GroupCreateRequest(msgspec.Struct):
     name: str
     type: str = "public" # public or private
     password: Optional[str] = None
 
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_WORKERS, thread_name_prefix="pbkdf2")
+
+def _hash_password(password: str) -> str:
+    salt = os.urandom(16)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, PASSWORD_ITERATIONS)
+    return f"pbkdf2_sha256${PASSWORD_ITERATIONS}${salt.hex()}${digest.hex()}"
+
+def _check_password(stored: str, password: str) -> bool:
+    if not stored.startswith("pbkdf2_sha256$"): # Groups created before passwords were hashed
+        return hmac.compare_digest(stored.encode(), password.encode())
+    _, iterations, salt, digest = stored.split("$")
+    candidate = hashlib.pbkdf2_hmac("sha256", password.encode(), bytes.fromhex(salt), int(iterations))
+    return hmac.compare_digest(candidate.hex(), digest)
+
+def _needs_rehash(stored: str) -> bool:
+    # Plaintext from before hashing, or a hash made with fewer rounds than PASSWORD_ITERATIONS
+    return not stored.startswith("pbkdf2_sha256$") or int(stored.split("$")[1]) < PASSWORD_ITERATIONS
+
+# msgspec bodies bypass FastAPI's model handling, so the schema is attached to the route by hand
+_, _GROUP_CREATE_SCHEMAS = msgspec.json.schema_components([GroupCreateRequest])
+GROUP_CREATE_OPENAPI = {"requestBody": {"required": True, "content": {"application/json": {"schema": _GROUP_CREATE_SCHEMAS["GroupCreateRequest"]}}}}
+
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: Dict[str, List[WebSocket]] = {}
+        self.active_connections: Dict[str, Set[WebSocket]] = {}
         self.global_lookup: Dict[str, WebSocket] = {}
         self.user_meta: Dict[str, dict] = {}
+        self.group_members: Dict[str, Dict[str, dict]] = {} # group -> {uid: meta}, so presence is O(group size)
+        self.ws_meta: Dict[WebSocket, Tuple[str, str]] = {} # websocket -> (group_id, user_id)
+        self.outbox: Dict[str, asyncio.Queue] = {} # Pending frames per group, drained by _flusher
+        self.flushers: Dict[str, asyncio.Task] = {}
+        self.pending_leaves: Dict[Tuple[str, str], asyncio.Task] = {}
+        self.vc_connections: Dict[str, Set[WebSocket]] = {} # Subset of each group's sockets currently in VC
+        self.send_queues: Dict[WebSocket, asyncio.Queue] = {} # Bounded per-socket outbound frames
+        self.writers: Dict[WebSocket, asyncio.Task] = {}
+        self.presence_dirty: Set[str] = set() # Groups whose presence changed since the last flush
+        self.presence_task: Optional[asyncio.Task] = None
 
     async def connect(self, websocket: WebSocket, group_id: str, user_info: dict):
         uid = user_info['id']
-        if group_id not in self.active_connections:
-            self.active_connections[group_id] = []
-        self.active_connections[group_id].append(websocket)
+        pending = self.pending_leaves.pop((group_id, uid), None)
+        if pending: pending.cancel() # Quick reconnect: the join broadcast below replaces the leave
+        first_local = group_id not in self.active_connections
+        self.active_connections.setdefault(group_id, set()).add(websocket)
+        if first_local:
+            self.outbox[group_id] = asyncio.Queue()
+            self.flushers[group_id] = asyncio.create_task(self._flusher(group_id))
+            if SCALE_OUT:
+                try: await pubsub.subscribe(group_channel_for(group_id), vc_channel_for(group_id))
+                except BaseException:
+                    # Undo the registration, or later sockets would see the group as subscribed and never retry
+                    self._drop_connection(websocket, group_id)
+                    raise
+        self.ws_meta[websocket] = (group_id, uid)
+        self.send_queues[websocket] = queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        self.writers[websocket] = asyncio.create_task(self._writer(websocket, queue))
         self.global_lookup[uid] = websocket
-        self.user_meta[uid] = {**user_info, "group": group_id}
-        await self.broadcast_presence(group_id)
-
-    def disconnect(self, websocket: WebSocket, group_id: str, user_id: str):
-        if group_id in self.active_connections:
-            if websocket in self.active_connections[group_id]:
-                self.active_connections[group_id].remove(websocket)
-        if user_id in self.global_lookup: del self.global_lookup[user_id]
-        if user_id in self.user_meta: del self.user_meta[user_id]
-
-    async def broadcast_presence(self, group_id: str):
-        users = [m for uid, m in self.user_meta.items() if m.get("group") == group_id]
-        payload = json.dumps({"type": "presence_update", "group_id": group_id, "count": len(users), "users": users})
-        await self.broadcast_local(group_id, payload)
-
-    async def broadcast_local(self, group_id: str, message: str):
-        if group_id in self.active_connections:
-            for connection in self.active_connections[group_id]:
-                try: await connection.send_text(message)
-                except: pass
-
-    async def send_personal_message(self, target_id: str, message: str):
-        if target_id in self.global_lookup:
-            try: await self.global_lookup[target_id].send_text(message); return True
-            except: return False
-        return False
+        self._drop_member(uid) # A user is listed in one group at a time
+        self.user_meta[uid] = meta = {**user_info, "group": group_id}
+        self.group_members.setdefault(group_id, {})[uid] = meta
+        self.broadcast_presence(group_id)
+
+    async def disconnect(self, websocket: WebSocket, group_id: str, user_id: str):
+        group_id, user_id = self.ws_meta.pop(websocket, (group_id, user_id))
+        self.send_queues.pop(websocket, None)
+        writer = self.writers.pop(websocket, None)
+        if writer: writer.cancel()
+        self.leave_vc(websocket, group_id)
+        # A reconnect (e.g. group switch) may already have registered a newer socket for this user
+        if self.global_lookup.get(user_id) is websocket:
+            del self.global_lookup[user_id]
+            self._drop_member(user_id)
+        if self._drop_connection(websocket, group_id) and SCALE_OUT:
+            await pubsub.unsubscribe(group_channel_for(group_id), vc_channel_for(group_id))
+
+    def _drop_connection(self, websocket: WebSocket, group_id: str) -> bool:
+        # Returns True if this was the group's last local socket and its flusher was stopped
+        conns = self.active_connections.get(group_id, set())
+        conns.discard(websocket)
+        if conns or self.active_connections.pop(group_id, None) is None: return False
+        self.flushers.pop(group_id).cancel()
+        del self.outbox[group_id]
+        return True
+
+    def _drop_member(self, user_id: str):
+        meta = self.user_meta.pop(user_id, None)
+        if meta is None: return
+        members = self.group_members.get(meta["group"])
+        if members is None: return
+        members.pop(user_id, None)
+        if not members: del self.group_members[meta["group"]]
+
+    def join_vc(self, websocket: WebSocket, group_id: str):
+        self.vc_connections.setdefault(group_id, set()).add(websocket)
+
+    def leave_vc(self, websocket: WebSocket, group_id: str):
+        conns = self.vc_connections.get(group_id)
+        if conns is None: return
+        conns.discard(websocket)
+        if not conns: del self.vc_connections[group_id]
+
+    def schedule_leave(self, group_id: str, user_id: str):
+        # Page refreshes and network blips reconnect within seconds, so leaves are announced late
+        if group_id not in self.active_connections: return
+        pending = self.pending_leaves.pop((group_id, user_id), None)
+        if pending: pending.cancel()
+        self.pending_leaves[(group_id, user_id)] = asyncio.create_task(self._delayed_leave(group_id, user_id))
+
+    async def _delayed_leave(self, group_id: str, user_id: str):
+        await asyncio.sleep(LEAVE_GRACE)
+        del self.pending_leaves[(group_id, user_id)]
+        self.broadcast_presence(group_id)
+
+    def broadcast_presence(self, group_id: str):
+        # Join storms (restarts, mobile reconnects) would otherwise send N growing payloads per group
+        self.presence_dirty.add(group_id)
+        if self.presence_task is None or self.presence_task.done():
+            self.presence_task = asyncio.create_task(self._flush_presence())
+
+    async def _flush_presence(self):
+        await asyncio.sleep(PRESENCE_DEBOUNCE)
+        dirty, self.presence_dirty = self.presence_dirty, set()
+        for group_id in dirty: self._send_presence(group_id)
+
+    def _send_presence(self, group_id: str):
+        users = list(self.group_members.get(group_id, {}).values())
+        payload = orjson.dumps({"type": "presence_update", "group_id": group_id, "count": len(users), "users": users})
+        self.broadcast_local(group_id, payload)
+
+    def broadcast_local(self, group_id: str, message: bytes):
+        queue = self.outbox.get(group_id)
+        if queue: queue.put_nowait(message)
+
+    def enqueue(self, websocket: WebSocket, message: bytes) -> bool:
+        queue = self.send_queues.get(websocket)
+        if queue is None: return False
+        try: queue.put_nowait(message)
+        except asyncio.QueueFull:
+            # The client stopped reading; drop it rather than buffer without bound
+            del self.send_queues[websocket]
+            asyncio.create_task(self._close_slow(websocket))
+            return False
+        return True
+
+    async def _writer(self, websocket: WebSocket, queue: asyncio.Queue):
+        try:
+            while True: await websocket.send_bytes(await queue.get())
+        except (WebSocketDisconnect, RuntimeError, OSError):
+            # Dead socket: stop queueing for it now; its receive loop finishes the cleanup
+            self.send_queues.pop(websocket, None)
+
+    async def _close_slow(self, websocket: WebSocket):
+        writer = self.writers.get(websocket)
+        if writer: writer.cancel()
+        try: await websocket.close(code=1013) # "Try again later"
+        except (RuntimeError, OSError): pass # Already closed
+
+    async def _flusher(self, group_id: str):
+        # Everything queued since the last send goes out as one JSON array frame per client
+        queue = self.outbox[group_id]
+        while True:
+            batch = [await queue.get()]
+            while not queue.empty(): batch.append(queue.get_nowait())
+            frame = b"[" + b",".join(batch) + b"]"
+            if len(frame) >= COMPRESS_MIN: frame = zlib.compress(frame, 1)
+            # Handing the frame to each socket's writer never waits, so a slow client can't stall the group
+            for connection in tuple(self.active_connections.get(group_id, ())): # enqueue may drop a socket
+                self.enqueue(connection, frame)
+
+    def broadcast_vc(self, group_id: str, message: bytes):
+        # Chat-only watchers ignore voice signaling, so it skips the group outbox
+        for connection in tuple(self.vc_connections.get(group_id, ())):
+            self.enqueue(connection, message)
+
+    def send_personal_message(self, target_id: str, message: bytes) -> bool:
+        websocket = self.global_lookup.get(target_id)
+        return websocket is not None and self.enqueue(websocket, message)
 
 manager = ConnectionManager()
 
-async def redis_listener():
-    pubsub = redis.pubsub()
-    await pubsub.subscribe(GLOBAL_CHANNEL)
-    async for message in pubsub.listen():
-        if message["type"] == "message":
+def relay_frame(payload: bytes) -> bytes:
+    # Group/VC channel frames are "<node id>\x1f<json>" so the sender can drop its own echo
+    return NODE_ID + b"\x1f" + payload
+
+async def emit_to_group(group_id: str, payload: bytes):
+    # Local sockets are served directly; Redis only relays to the other processes
+    manager.broadcast_local(group_id, payload)
+    if SCALE_OUT: await redis_bin.publish(group_channel_for(group_id), relay_frame(payload))
+
+async def emit_to_vc(group_id: str, payload: bytes):
+    manager.broadcast_vc(group_id, payload)
+    if SCALE_OUT: await redis_bin.publish(vc_channel_for(group_id), relay_frame(payload))
+
+async def handle_pubsub_message(message: dict):
+    try:
+        channel = message["channel"].decode()
+        if channel == GROUPS_CHANGED_CHANNEL:
+            _invalidate_group(message["data"].decode())
+            return
+        # The channel name already encodes the group, no payload routing needed
+        if channel.startswith((GROUP_CHANNEL, VC_CHANNEL)):
+            origin, _, body = message["data"].partition(b"\x1f")
+            if origin == NODE_ID: return # Already delivered locally by emit_to_group/emit_to_vc
+            if channel.startswith(GROUP_CHANNEL): manager.broadcast_local(channel[len(GROUP_CHANNEL):], body)
+            else: manager.broadcast_vc(channel[len(VC_CHANNEL):], body)
+            return
+        target_id, _, body = message["data"].partition(b"\x1f")
+        manager.send_personal_message(target_id.decode(), body)
+    except (ValueError, AttributeError): pass # Malformed payload from another publisher
+
+ingress_queue: asyncio.Queue = asyncio.Queue(maxsize=INGRESS_QUEUE_SIZE) # (group_id, msg_id, payload)
+
+async def _queue_ingress(pipe, group_id: str, msg_id: str, payload: bytes):
+    await INGRESS_LUA(
+        keys=[history_key_for(group_id), group_channel_for(group_id), msg_index_key_for(group_id)],
+        args=[payload, MAX_HISTORY, INGRESS_RELAY_PREFIX, msg_id],
+        client=pipe,
+    )
+
+async def ingress_writer():
+    # Everything queued since the last round trip is written in one pipeline, in arrival order
+    while True:
+        batch = [await ingress_queue.get()]
+        while len(batch) < INGRESS_BATCH and not ingress_queue.empty(): batch.append(ingress_queue.get_nowait())
+        for attempt in range(1, INGRESS_RETRIES + 1):
             try:
-                data = json.loads(message["data"])
-                mtype = data.get("type")
-                # Broadcast relevant types to the group
-                if mtype in ["message", "edit_message", "delete_message", "vc_signal_group", "vc_user_state"]:
-                    await manager.broadcast_local(data.get("group_id"), message["data"])
-                elif mtype == "dm":
-                    await manager.send_personal_message(data.get("target_id"), message["data"])
-            except: pass
+                async with redis_bin.pipeline(transaction=False) as pipe:
+                    for item in batch: await _queue_ingress(pipe, *item)
+                    await pipe.execute()
+                break
+            except (aioredis.RedisError, OSError):
+                logger.exception("Ingress write of %d messages failed (attempt %d/%d)", len(batch), attempt, INGRESS_RETRIES)
+                if attempt < INGRESS_RETRIES: await asyncio.sleep(attempt) # INGRESS_LUA skips ids already written
+        else: logger.error("Dropped %d messages from history; they were delivered locally only", len(batch))
+        for _ in batch: ingress_queue.task_done()
+
+async def redis_listener():
+    # startup_event already subscribed the node-wide channels, so the shared PubSub connection exists before
+    # any socket's first subscribe; group channels are (un)subscribed by the ConnectionManager as sockets come and go
+    backoff = 1.0
+    while True:
+        try:
+            while True:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                while message:
+                    if message["type"] == "message": await handle_pubsub_message(message)
+                    # Drain the rest of a burst without waiting, so it lands in the same outbox batch
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=0)
+        except (aioredis.RedisError, OSError):
+            logger.exception("Redis listener failed; resubscribing in %.0fs", backoff)
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, LISTENER_BACKOFF_MAX)
+            # Relays and group changes published meanwhile were missed: rejoin every locally active group
+            # and drop group caches that may have been invalidated while disconnected
+            channels = [GLOBAL_CHANNEL, GROUPS_CHANGED_CHANNEL]
+            for group_id in manager.active_connections: channels += [group_channel_for(group_id), vc_channel_for(group_id)]
+            _groups_cache["ts"] = 0.0
+            _private_cache.clear()
+            try: await pubsub.subscribe(*channels)
+            except (aioredis.RedisError, OSError): continue # Still down; the next read fails and backs off further
+            backoff = 1.0
+
+async def _migrate_history():
+    # History lists were once unbounded and unindexed; fixing both here once keeps ingress from ever trimming
+    # a huge backlog and lets edit/delete treat an index miss as "not found"
+    if await redis.get(HISTORY_MIGRATION_KEY) == str(HISTORY_MIGRATION): return
+    async for key in redis.scan_iter(match=f"{HISTORY_KEY}*", count=500):
+        await MIGRATE_HISTORY_LUA(keys=[key, msg_index_key_for(key[len(HISTORY_KEY):])], args=[MAX_HISTORY], client=redis_bin)
+    await redis.set(HISTORY_MIGRATION_KEY, HISTORY_MIGRATION)
 
 @app.on_event("startup")
 async def startup_event():
+    await MIGRATE_GROUPS_LUA(keys=[GROUPS_KEY], client=redis)
+    await _migrate_history()
     # Ensure Lobby exists
-    if not await redis.sismember(GROUPS_KEY, "Lobby"): 
-        await redis.sadd(GROUPS_KEY, "Lobby")
-    asyncio.create_task(redis_listener())
+    await redis.zadd(GROUPS_KEY, {"Lobby": 0}, nx=True)
+    asyncio.create_task(ingress_writer())
+    if SCALE_OUT:
+        # Subscribing here, before any socket is served, keeps two coroutines from opening the PubSub connection at once
+        await pubsub.subscribe(GLOBAL_CHANNEL, GROUPS_CHANGED_CHANNEL)
+        asyncio.create_task(redis_listener())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Messages already delivered locally but still queued would otherwise never reach history
+    try: await asyncio.wait_for(ingress_queue.join(), INGRESS_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError: logger.error("Shutting down with %d messages not written to history", ingress_queue.qsize())
 
 # ===========================
 # PUBLIC API ENDPOINTS
 # ===========================
 
 @app.get("/api/groups", tags=["Groups"], summary="List public groups")
-async def get_groups():
-    """Returns a list of all public groups."""
-    return {"groups": sorted(list(await redis.smembers(GROUPS_KEY)))}
-
-@app.post("/api/groups/create", tags=["Groups"], summary="Create a new group")
-async def create_group(group: GroupCreateRequest):
-    safe_name = "".join(x for x in group.name if x.isalnum() or x in "-_")
+async def get_groups(cursor: Optional[str] = None, limit: int = GROUPS_PAGE):
+    """Returns a list of all public groups. Pass `cursor` (empty for the first page) to get one page as
+    `items` plus the `cursor` for the next page, which is null after the last one."""
+    if cursor is not None:
+        limit = max(1, min(limit, GROUPS_PAGE))
+        items = await redis.zrangebylex(GROUPS_KEY, f"({cursor}" if cursor else "-", "+", start=0, num=limit)
+        return {"items": items, "cursor": items[-1] if len(items) == limit else None}
+    if time.monotonic() - _groups_cache["ts"] >= GROUPS_CACHE_TTL:
+        # Already in name order; read in pages so a large list never ties Redis up in one reply
+        groups, start = [], "-"
+        while True:
+            page = await redis.zrangebylex(GROUPS_KEY, start, "+", start=0, num=GROUPS_PAGE)
+            groups += page
+            if len(page) < GROUPS_PAGE: break
+            start = f"({page[-1]}"
+        _groups_cache["groups"] = groups
+        _groups_cache["ts"] = time.monotonic()
+    return {"groups": _groups_cache["groups"]}
+
+@app.post("/api/groups/create", tags=["Groups"], summary="Create a new group", openapi_extra=GROUP_CREATE_OPENAPI)
+async def create_group(request: Request):
+    try: group = msgspec.json.decode(await request.body(), type=GroupCreateRequest)
+    except msgspec.DecodeError as e: raise HTTPException(422, str(e)) # ValidationError subclasses DecodeError
+    if len(group.name) > 256: raise HTTPException(400, "Name too long")
+    safe_name = _UNSAFE_NAME_RE.sub("", group.name)[:GROUP_NAME_MAX]
     if len(safe_name) < 3: raise HTTPException(400, "Name too short")
+    password_hash = ""
+    if group.type == "private" and group.password:
+        await _take_password_attempt(request)
+        # PBKDF2 is deliberately slow, so it runs off the event loop
+        password_hash = await asyncio.get_running_loop().run_in_executor(password_executor, _hash_password, group.password)
     
-    if await redis.sismember(GROUPS_KEY, safe_name) or await redis.sismember(PVT_GROUPS_KEY, safe_name):
-        raise HTTPException(400, "Group already exists")
-
-    if group.type == "private":
-        await redis.sadd(PVT_GROUPS_KEY, safe_name)
-        if group.password:
-            await redis.hset(f"{GROUP_META_KEY}{safe_name}", mapping={"password": group.password, "type": "private"})
-    else:
-        await redis.sadd(GROUPS_KEY, safe_name)
+    created = await CREATE_GROUP_LUA(
+        keys=[GROUPS_KEY, PVT_GROUPS_KEY, f"{GROUP_META_KEY}{safe_name}", GROUPS_CHANGED_CHANNEL],
+        args=[safe_name, group.type, password_hash, "1" if SCALE_OUT else "0"],
+        client=redis,
+    )
+    if not created: raise HTTPException(400, "Group already exists")
+    _invalidate_group(safe_name)
     
     return {"status": "created", "name": safe_name, "type": group.type}
 
+async def _take_password_attempt(request: Request):
+    # Every attempt costs a PBKDF2 run, so it is rate limited per client IP before any hashing
+    attempt = os.urandom(4).hex()
+    if not await ACQUIRE_UPLOAD_SLOT_LUA(keys=[f"{PASSWORD_ATTEMPTS_KEY}{_client_ip(request)}"], args=[time.time(), PASSWORD_ATTEMPT_WINDOW, PASSWORD_ATTEMPTS, attempt], client=redis):
+        raise HTTPException(429, "Too many password attempts")
+
 @app.post("/api/groups/join_private", tags=["Groups"])
-async def check_private_group(name: str = Form(...), password: str = Form("")):
-    if not await redis.sismember(PVT_GROUPS_KEY, name):
+async def check_private_group(request: Request, name: str = Form(...), password: str = Form("")):
+    cached = _private_cache.get(name)
+    if cached and time.monotonic() - cached[0] < GROUPS_CACHE_TTL: stored_pass = cached[1]
+    else:
+        stored_pass = await PRIVATE_GROUP_PASSWORD_LUA(keys=[PVT_GROUPS_KEY, f"{GROUP_META_KEY}{name}"], args=[name], client=redis)
+        if len(_private_cache) >= 4096: _private_cache.clear() # Misses for made-up names must not grow it forever
+        _private_cache[name] = (time.monotonic(), stored_pass)
+    if stored_pass is None:
         raise HTTPException(404, "Group not found")
     
-    meta = await redis.hgetall(f"{GROUP_META_KEY}{name}")
-    stored_pass = meta.get("password")
-    
-    if stored_pass and stored_pass != password:
+    if not stored_pass: return {"status": "authorized", "group": name}
+    await _take_password_attempt(request)
+    loop = asyncio.get_running_loop()
+    if not await loop.run_in_executor(password_executor, _check_password, stored_pass, password):
         raise HTTPException(403, "Invalid Password")
+    if _needs_rehash(stored_pass):
+        # The password was just verified, so it can be stored the current way
+        stored_pass = await loop.run_in_executor(password_executor, _hash_password, password)
+        await redis.hset(f"{GROUP_META_KEY}{name}", "password", stored_pass)
+        _private_cache[name] = (time.monotonic(), stored_pass)
         
     return {"status": "authorized", "group": name}
 
 @app.get("/api/history/{group_id}", tags=["Chat"])
 async def get_history(group_id: str, limit: int = 100):
-    messages = await redis.lrange(f"{HISTORY_KEY}{group_id}", -limit, -1)
-    return [json.loads(m) for m in messages]
-
-@app.post("/api/upload", tags=["Files"])
-async def upload_file(file: UploadFile = File(...)):
-    ext = file.filename.split('.')[-1]
-    safe_name = f"{int(time.time())}_{os.urandom(4).hex()}.{ext}"
-    file_key = f"kustify_v9/{safe_name}"
-    s3_client.upload_fileobj(file.file, BUCKET_NAME, file_key, ExtraArgs={'ContentType': file.content_type})
-    url = s3_client.generate_presigned_url('get_object', Params={'Bucket': BUCKET_NAME, 'Key': file_key}, ExpiresIn=604800)
+    limit = max(1, min(limit, HISTORY_LIMIT_MAX)) # LRANGE -0 -1 would return the whole list
+    messages = await redis_bin.lrange(history_key_for(group_id), -limit, -1)
+    # Stored entries are already JSON objects, so join them instead of parsing and re-encoding
+    return Response(content=b"[" + b",".join(messages) + b"]", media_type="application/json")
+
+def _upload_key(filename: str) -> str:
+    ext = os.path.splitext(filename or "")[1].lstrip(".") or "bin" # "photo" would otherwise become the extension
+    return f"{UPLOAD_KEY_PREFIX}{int(time.time())}_{secrets.token_urlsafe(6)}.{ext}"
+
+@app.post("/api/upload/presign", tags=["Files"], summary="Presigned POST for uploading straight to S3")
+async def presign_upload(filename: str = Form(""), content_type: str = Form("application/octet-stream")):
+    """The client posts the file to S3 itself, then shares `url`; the file never passes through this server."""
+    file_key = _upload_key(filename)
+    post = s3_client.generate_presigned_post(
+        BUCKET_NAME, file_key,
+        Fields={"Content-Type": content_type},
+        Conditions=[{"Content-Type": content_type}, ["content-length-range", 0, UPLOAD_MAX_BYTES]],
+        ExpiresIn=300,
+    )
+    return {"upload": post, "url": _sign_get_url(file_key, 604800)}
+
+def _client_ip(request: Request) -> str:
+    # The trusted router appends the real peer to X-Forwarded-For; earlier entries are client-supplied
+    forwarded = request.headers.get("x-forwarded-for") if TRUST_PROXY else None
+    if forwarded: return forwarded.rsplit(",", 1)[-1].strip()
+    return request.client.host if request.client else "unknown"
+
+@app.post("/api/upload", tags=["Files"], deprecated=True)
+async def upload_file(request: Request, file: UploadFile = File(...)):
+    """Fallback for when direct uploads fail (e.g. bucket CORS not configured); prefer /api/upload/presign."""
+    slots_key, slot = f"{UPLOAD_SLOTS_KEY}{_client_ip(request)}", os.urandom(4).hex()
+    if not await ACQUIRE_UPLOAD_SLOT_LUA(keys=[slots_key], args=[time.time(), UPLOAD_SLOT_TTL, UPLOAD_CONCURRENCY, slot], client=redis):
+        raise HTTPException(429, "Too many uploads in progress")
+    try:
+        file_key = _upload_key(file.filename)
+        file.file.seek(0)
+        # boto3 is blocking; run the transfer in a worker thread so the event loop keeps serving sockets
+        await asyncio.to_thread(s3_client.upload_fileobj, file.file, BUCKET_NAME, file_key, ExtraArgs={'ContentType': file.content_type}, Config=UPLOAD_TRANSFER_CONFIG)
+    finally:
+        await redis.zrem(slots_key, slot)
+    url = _sign_get_url(file_key, 604800)
     return {"url": url}
 
 # ===========================
 # WEBSOCKET
 # ===========================
 
+async def _handle_message(websocket: WebSocket, ctx: dict, data: dict):
+    text = data.get("text")
+    if not isinstance(text, str) or len(text) > MAX_TEXT: return
+    group_id = ctx["group_id"]
+    data.update({
+        "id": f"{_MSG_ID_PREFIX}{next(_MSG_SEQ)}", # Millisecond stamps collided for messages sent together
+        "user_id": ctx["user_id"], 
+        "user_name": ctx["name"], 
+        "user_pfp": ctx["custom_pfp"], # Empty = default identicon, derived client-side from user_id
+        "group_id": group_id, 
+        "timestamp": time.time()
+    })
+    payload = orjson.dumps(data)
+    manager.broadcast_local(group_id, payload)
+    # Persisting and relaying is batched by ingress_writer, so the sender doesn't wait on a Redis round trip
+    try: ingress_queue.put_nowait((group_id, data["id"], payload))
+    except asyncio.QueueFull:
+        async with redis_bin.pipeline(transaction=False) as pipe:
+            await _queue_ingress(pipe, group_id, data["id"], payload)
+            await pipe.execute()
+
+async def _handle_edit(websocket: WebSocket, ctx: dict, data: dict):
+    msg_id, new_text = data.get("message_id"), data.get("new_text")
+    if not isinstance(msg_id, str) or not isinstance(new_text, str) or len(new_text) > MAX_TEXT: return
+    if not await EDIT_LUA(keys=[ctx["history_key"], ctx["index_key"]], args=[msg_id, ctx["user_id"], new_text], client=redis_bin): return
+    await emit_to_group(ctx["group_id"], orjson.dumps({
+        "type": "edit_message", 
+        "group_id": ctx["group_id"], 
+        "id": msg_id, 
+        "text": new_text
+    }))
+
+async def _handle_delete(websocket: WebSocket, ctx: dict, data: dict):
+    msg_id = data.get("message_id")
+    if not isinstance(msg_id, str): return
+    if not await DELETE_LUA(keys=[ctx["history_key"], ctx["index_key"]], args=[msg_id, ctx["user_id"]], client=redis_bin): return
+    await emit_to_group(ctx["group_id"], orjson.dumps({"type": "delete_message", "group_id": ctx["group_id"], "id": msg_id}))
+
+# --- Voice Chat Signaling ---
+# Signals are relayed to the group's VC members so peers can connect
+async def _relay_vc_signal(ctx: dict, data: dict):
+    data.update({"type": "vc_signal_group", "sender_id": ctx["user_id"], "group_id": ctx["group_id"]})
+    await emit_to_vc(ctx["group_id"], orjson.dumps(data))
+
+async def _handle_vc_join(websocket: WebSocket, ctx: dict, data: dict):
+    manager.join_vc(websocket, ctx["group_id"])
+    await _relay_vc_signal(ctx, data)
+
+async def _handle_vc_leave(websocket: WebSocket, ctx: dict, data: dict):
+    await _relay_vc_signal(ctx, data)
+    manager.leave_vc(websocket, ctx["group_id"])
+
+async def _handle_vc_signal(websocket: WebSocket, ctx: dict, data: dict):
+    await _relay_vc_signal(ctx, data)
+
+async def _handle_dm(websocket: WebSocket, ctx: dict, data: dict):
+    target_id = data.get("target_id")
+    if not isinstance(target_id, str): return
+    data.update({"sender_id": ctx["user_id"], "sender_name": ctx["name"], "timestamp": time.time()})
+    payload = orjson.dumps(data)
+    # Only targets connected to another process need the Redis hop
+    if not manager.send_personal_message(target_id, payload) and SCALE_OUT:
+        await redis_bin.publish(GLOBAL_CHANNEL, target_id.encode() + b"\x1f" + payload)
+    manager.enqueue(websocket, payload) # Echo to the sender's own view
+
+async def _noop(websocket: WebSocket, ctx: dict, data: dict): pass
+
+HANDLERS = {
+    "message": _handle_message,
+    "edit_message": _handle_edit,
+    "delete_message": _handle_delete,
+    "vc_join": _handle_vc_join,
+    "vc_leave": _handle_vc_leave,
+    "vc_signal": _handle_vc_signal,
+    "dm": _handle_dm,
+}
+
 @app.websocket("/ws/{group_id}/{user_id}")
 async def websocket_endpoint(websocket: WebSocket, group_id: str, user_id: str):
     await websocket.accept()
     try:
-        init_data = await websocket.receive_json()
+        init_data = orjson.loads(await websocket.receive_text())
         name = init_data.get("name", "Anon").strip()
-        pfp = init_data.get("pfp", "").strip()
-        if not pfp: pfp = "https://api.dicebear.com/7.x/identicon/svg?seed=" + user_id
+        custom_pfp = init_data.get("pfp", "").strip()
+        pfp = custom_pfp or "https://api.dicebear.com/7.x/identicon/svg?seed=" + user_id
         
         user_info = {"id": user_id, "name": name, "pfp": pfp}
-        await manager.connect(websocket, group_id, user_info)
-    except: return
+    except (WebSocketDisconnect, ValueError, AttributeError): return # Gone or sent a malformed handshake
 
+    # Per-connection state shared by the handlers
+    ctx = {"group_id": group_id, "user_id": user_id, "name": name, "custom_pfp": custom_pfp, "history_key": history_key_for(group_id), "index_key": msg_index_key_for(group_id)}
     try:
+        await manager.connect(websocket, group_id, user_info)
+        # History rides the socket, saving the client a separate /api/history request
+        history = await redis_bin.lrange(ctx["history_key"], -HISTORY_REPLAY, -1)
+        frame = b'{"type":"history","items":[' + b",".join(history) + b"]}"
+        manager.enqueue(websocket, zlib.compress(frame, 1) if len(frame) >= COMPRESS_MIN else frame)
         while True:
-            data = await websocket.receive_json()
-            mtype = data.get("type")
-
-            if mtype == "message":
-                data.update({
-                    "id": f"msg_{int(time.time()*1000)}", 
-                    "user_id": user_id, 
-                    "user_name": name, 
-                    "user_pfp": user_info["pfp"],
-                    "group_id": group_id, 
-                    "timestamp": time.time()
-                })
-                await redis.rpush(f"{HISTORY_KEY}{group_id}", json.dumps(data))
-                await redis.publish(GLOBAL_CHANNEL, json.dumps(data))
-
-            elif mtype == "edit_message":
-                msg_id = data.get("message_id")
-                history_key = f"{HISTORY_KEY}{group_id}"
-                msgs = await redis.lrange(history_key, 0, -1)
-                for i, m_str in enumerate(msgs):
-                    m = json.loads(m_str)
-                    if m.get("id") == msg_id and m.get("user_id") == user_id:
-                        m["text"] = data.get("new_text")
-                        m["edited"] = True
-                        await redis.lset(history_key, i, json.dumps(m))
-                        await redis.publish(GLOBAL_CHANNEL, json.dumps({
-                            "type": "edit_message", 
-                            "group_id": group_id, 
-                            "id": msg_id, 
-                            "text": m["text"]
-                        }))
-                        break
-
-            elif mtype == "delete_message":
-                msg_id = data.get("message_id")
-                history_key = f"{HISTORY_KEY}{group_id}"
-                msgs = await redis.lrange(history_key, 0, -1)
-                for m_str in msgs:
-                    m = json.loads(m_str)
-                    if m.get("id") == msg_id and m.get("user_id") == user_id:
-                        await redis.lrem(history_key, 1, m_str)
-                        await redis.publish(GLOBAL_CHANNEL, json.dumps({"type": "delete_message", "group_id": group_id, "id": msg_id}))
-                        break
-            
-            # --- Voice Chat Signaling ---
-            elif mtype in ["vc_join", "vc_leave", "vc_signal"]:
-                data.update({"sender_id": user_id, "group_id": group_id})
-                # Broadcast signals to group so peers can connect
-                await redis.publish(GLOBAL_CHANNEL, json.dumps({**data, "type": "vc_signal_group"}))
-
-    except WebSocketDisconnect:
-        manager.disconnect(websocket, group_id, user_id)
-        await manager.broadcast_presence(group_id)
+            raw = await websocket.receive_text()
+            if len(raw) > MAX_FRAME: await websocket.close(code=1009); break # "Message too big"
+            data = orjson.loads(raw)
+            if not isinstance(data, dict): await websocket.close(code=1003); break # JSON, but not a frame object
+            msg_type = data.get("type")
+            if msg_type == "heartbeat": manager.enqueue(websocket, HEARTBEAT_ACK); continue
+            if not isinstance(msg_type, str): continue # e.g. a list, which can't even be looked up in HANDLERS
+            try: await HANDLERS.get(msg_type, _noop)(websocket, ctx, data)
+            except aioredis.RedisError: logger.exception("Redis error handling %r frame", msg_type) # Transient; keep the socket
+
+    except WebSocketDisconnect: pass
+    except ValueError: await websocket.close(code=1003) # Not JSON
+    finally:
+        # Also runs when a handler raises, so no socket stays registered as a ghost
+        await manager.disconnect(websocket, group_id, user_id)
+        manager.schedule_leave(group_id, user_id)
 
 @app.get("/")
-async def get(): return HTMLResponse(html_content)
+async def get(accept_encoding: str = Header("")):
+    # The page is static, so it is compressed once at import instead of per request
+    if "gzip" in accept_encoding: return HTMLResponse(HTML_GZIP, headers={"Content-Encoding": "gzip", "Vary": "Accept-Encoding"})
+    return HTMLResponse(HTML_BYTES, headers={"Vary": "Accept-Encoding"})
 
 html_content = """
 <!DOCTYPE html>
@@ -454,6 +1006,8 @@ html_content = """
             joinedPvtGroups: JSON.parse(localStorage.getItem('k_joined_groups') || '[]')
         };
 
+        const utf8 = new TextDecoder();
+
         function setCookie(n, v) { const d = new Date(); d.setTime(d.getTime() + (365*24*60*60*1000)); document.cookie = `${n}=${v};expires=${d.toUTCString()};path=/`; }
         function getCookie(n) { const v = document.cookie.match('(^|;) ?' + n + '=([^;]*)(;|$)'); return v ? v[2] : null; }
 
@@ -587,25 +1141,48 @@ html_content = """
             if(state.ws) state.ws.close();
             document.getElementById('chat-feed').innerHTML = '';
             
-            fetch(`/api/history/${state.group}`).then(r=>r.json()).then(m => m.forEach(renderMessage));
-            
             const proto = location.protocol === 'https:' ? 'wss' : 'ws';
             state.ws = new WebSocket(`${proto}://${location.host}/ws/${state.group}/${state.uid}`);
+            state.ws.binaryType = 'arraybuffer';
             state.ws.onopen = () => state.ws.send(JSON.stringify({name: state.user, pfp: state.pfp}));
+            // Keeps idle sockets from being reaped by proxies
+            clearInterval(state.heartbeat);
+            const ws = state.ws;
+            state.heartbeat = setInterval(() => { if(ws.readyState === WebSocket.OPEN) ws.send('{"type":"heartbeat"}'); }, 30000);
+            let rx = Promise.resolve(); // Inflating is async, so frames are chained to keep their order
             state.ws.onmessage = (e) => {
-                const d = JSON.parse(e.data);
-                if(d.type === "message") renderMessage(d);
-                if(d.type === "presence_update") document.getElementById('users-online').innerText = `● ${d.count} Online`;
-                if(d.type === "edit_message") {
-                    const el = document.querySelector(`[data-id="${d.id}"] .bubble`);
-                    if(el) el.innerHTML = marked.parse(d.text) + ' <small style="opacity:0.5; font-size:0.6rem;">(edited)</small>';
-                }
-                if(d.type === "delete_message") document.querySelector(`[data-id="${d.id}"]`)?.remove();
-                if(d.type === "vc_signal_group") handleVCSignal(d);
+                rx = rx.then(() => decodeFrame(e.data)).then(text => {
+                    // Group traffic arrives batched as a JSON array, direct messages as a single object
+                    const d = JSON.parse(text);
+                    (Array.isArray(d) ? d : [d]).forEach(handleEvent);
+                }).catch(console.error);
             };
         }
 
-        function renderMessage(d) {
+        async function decodeFrame(data) {
+            if(typeof data === 'string') return data;
+            // Large group frames are zlib-compressed server-side (0x78 header); JSON starts with '[' or '{'
+            if(new Uint8Array(data, 0, 1)[0] !== 0x78) return utf8.decode(data);
+            return new Response(new Blob([data]).stream().pipeThrough(new DecompressionStream('deflate'))).text();
+        }
+
+        function handleEvent(d) {
+            if(d.type === "message") renderMessage(d);
+            if(d.type === "history") {
+                // Live messages may have landed first; history goes above them, without duplicates
+                const first = document.getElementById('chat-feed').firstChild;
+                d.items.forEach(m => { if(!document.querySelector(`[data-id="${m.id}"]`)) renderMessage(m, first); });
+            }
+            if(d.type === "presence_update") document.getElementById('users-online').innerText = `● ${d.count} Online`;
+            if(d.type === "edit_message") {
+                const el = document.querySelector(`[data-id="${d.id}"] .bubble`);
+                if(el) el.innerHTML = marked.parse(d.text) + ' <small style="opacity:0.5; font-size:0.6rem;">(edited)</small>';
+            }
+            if(d.type === "delete_message") document.querySelector(`[data-id="${d.id}"]`)?.remove();
+            if(d.type === "vc_signal_group") handleVCSignal(d);
+        }
+
+        function renderMessage(d, before = null) {
             const feed = document.getElementById('chat-feed');
             const isMe = d.user_id === state.uid;
             const div = document.createElement('div');
@@ -630,7 +1207,7 @@ html_content = """
                     <div class="bubble">${marked.parse(d.text)}${d.edited ? ' <small style="opacity:0.5; font-size:0.6rem;">(edited)</small>' : ''}</div>
                 </div>
             `;
-            feed.appendChild(div); feed.scrollTop = feed.scrollHeight;
+            feed.insertBefore(div, before); feed.scrollTop = feed.scrollHeight;
         }
 
         function sendMessage() {
@@ -643,11 +1220,22 @@ html_content = """
         async function uploadFile(input) {
             const file = input.files[0];
             if(!file) return;
-            const fd = new FormData(); fd.append('file', file);
             try {
-                const r = await fetch('/api/upload', {method:'POST', body: fd});
-                const d = await r.json();
-                state.ws.send(JSON.stringify({type: "message", text: `![Image](${d.url})`}));
+                let url;
+                try {
+                    // Upload straight to S3; the server only signs the request
+                    const meta = new FormData(); meta.append('filename', file.name); meta.append('content_type', file.type || 'application/octet-stream');
+                    const p = await (await fetch('/api/upload/presign', {method:'POST', body: meta})).json();
+                    const fd = new FormData();
+                    Object.entries(p.upload.fields).forEach(([k, v]) => fd.append(k, v));
+                    fd.append('file', file);
+                    if(!(await fetch(p.upload.url, {method:'POST', body: fd})).ok) throw new Error('direct upload');
+                    url = p.url;
+                } catch(e) {
+                    const fd = new FormData(); fd.append('file', file);
+                    url = (await (await fetch('/api/upload', {method:'POST', body: fd})).json()).url;
+                }
+                state.ws.send(JSON.stringify({type: "message", text: `![Image](${url})`}));
             } catch(e) { alert("Upload Failed"); }
         }
 
@@ -866,3 +1454,5 @@ html_content = """
 </body>
 </html>
 """
+HTML_BYTES = html_content.encode()
+HTML_GZIP = gzip.compress(HTML_BYTES, 9, mtime=0)